@@ -1,4 +1,5 @@
 import requests
+from requests.adapters import HTTPAdapter
 
 class SkyPortal:
     """
@@ -16,6 +17,9 @@ class SkyPortal:
         SkyPortal API token
     validate : bool, optional
         If True, validate the SkyPortal instance and token
+    pool_size : int, optional
+        Maximum number of connections kept open to the instance, should be
+        at least the number of threads using the client concurrently
     
     Attributes
     ----------
@@ -23,9 +27,13 @@ class SkyPortal:
         Base URL of the SkyPortal instance
     headers : dict
         Authorization headers to use
+    session : requests.Session
+        Persistent HTTP session, reusing connections across requests
+    spectra_etag : str
+        ETag of the last spectra listing, sent back by conditional listings
     """
 
-    def __init__(self, instance, port, token, validate=True):
+    def __init__(self, instance, port, token, validate=True, pool_size=16):
         # build the base URL from the protocol, host, and port
         self.base_url = f'{instance}'
         if port not in ['None', '', 80, 443]:
@@ -33,6 +41,14 @@ class SkyPortal:
         
         self.headers = {'Authorization': f'token {token}'}
 
+        # reuse TCP/TLS connections instead of opening one per request
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.spectra_etag = None
+
         # ping it to make sure it's up, if validate is True
         if validate:
             if not self._ping(self.base_url):
@@ -55,7 +71,7 @@ class SkyPortal:
         bool
             True if the API is available, False otherwise
         """
-        response = requests.get(f"{base_url}/api/sysinfo")
+        response = self.session.get(f"{base_url}/api/sysinfo")
         return response.status_code == 200
     
     def _auth(self, base_url, headers):
@@ -74,7 +90,7 @@ class SkyPortal:
         bool
             True if the token is valid, False otherwise
         """
-        response = requests.get(
+        response = self.session.get(
             f"{base_url}/api/config",
             headers=headers
         )
@@ -102,12 +118,16 @@ class SkyPortal:
         dict
             JSON response
         """
+        response = self._request(method, endpoint, data)
+        return self._parse_response(response, return_raw)
+
+    def _request(self, method: str, endpoint: str, data=None, headers=None):
         endpoint = f'{self.base_url}/{endpoint.strip("/")}'
         if method == 'GET':
-            response = requests.request(method, endpoint, params=data, headers=self.headers)
-        else:
-            response = requests.request(method, endpoint, json=data, headers=self.headers)
+            return self.session.request(method, endpoint, params=data, headers=headers)
+        return self.session.request(method, endpoint, json=data, headers=headers)
 
+    def _parse_response(self, response, return_raw=False):
         if return_raw:
             return response.status_code, response.text
 
@@ -127,7 +147,8 @@ class SkyPortal:
             group_ids: list[int] = None,
             modified_after: str = None,
             modified_before: str = None,
-            minimal: bool = False
+            minimal: bool = False,
+            conditional: bool = False
         ):
         """
         Get spectra from SkyPortal (see https://skyportal.io/docs/api.html#tag/spectra/paths/~1api~1spectra/get)
@@ -148,6 +169,9 @@ class SkyPortal:
             Get spectra modified before this date
         minimal : bool, optional
             If True, return minimal payload (metadata only)
+        conditional : bool, optional
+            If True, send the ETag of the previous listing (If-None-Match) and return
+            an empty list without decoding anything if the server answers 304 Not Modified
 
         Returns
         -------
@@ -183,8 +207,14 @@ class SkyPortal:
 
         if len(data) == 0:
             raise ValueError('No query parameters provided, specify at least one')
-        response = self.api('GET', endpoint, data)
-        return response
+
+        headers = {'If-None-Match': self.spectra_etag} if conditional and self.spectra_etag else None
+        response = self._request('GET', endpoint, data, headers=headers)
+        if response.status_code == 304:
+            return 200, {'data': []}
+        if response.status_code == 200:
+            self.spectra_etag = response.headers.get('ETag')
+        return self._parse_response(response)
 
 
     def get_photometry(self, obj_id: str = None):
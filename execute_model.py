@@ -1,19 +1,297 @@
+import logging
+import os
+import threading
+
 import numpy as np
 import onnxruntime as ort
 
-from scipy.interpolate import interp1d
 from scipy.special import softmax
 
-def flux_zscore(spectra, wavelength_range=(3850, 8500), interp_length=4650):
+try:
+    from numba import njit
+except ImportError:  # numba is optional, flux_zscore then runs as plain numpy
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+logger = logging.getLogger(__name__)
+
+MODEL_PATH = "SpectraCNN1D_4650.onnx"
+QUANTIZED_MODEL_PATH = "SpectraCNN1D_4650.int8.onnx"
+INPUT_SHAPE = (1, 1, 4650)
+TRT_CACHE_PATH = "./trt_cache"
+# larger batches are split, which also bounds the number of TensorRT engines built for new batch sizes
+MAX_BATCH_SIZE = 32
+CLASSES = ['AGN', 'Cataclysmic', 'II', 'IIP', 'IIb',
+           'IIn', 'Ia', 'Ib', 'Ic', 'Tidal Disruption Event']
+
+# fast-math without 'nnan'/'ninf', which would let the compiler drop the isfinite mask
+_FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+# in order of preference, TensorRT caches its FP16 engines so they are not rebuilt at each start
+_PROVIDERS = [
+    ("TensorrtExecutionProvider", {
+        "trt_fp16_enable": True,
+        "trt_engine_cache_enable": True,
+        "trt_engine_cache_path": TRT_CACHE_PATH,
+    }),
+    "CUDAExecutionProvider",
+    "CPUExecutionProvider",
+]
+
+_model_path = MODEL_PATH
+
+_SESSION = None
+_INPUT_NAME = None
+_SESSION_LOCK = threading.Lock()
+_IO_BINDING = None
+_INPUT_VALUE = None
+# the bound input buffer and outputs are shared, one single-spectrum inference at a time
+_BINDING_LOCK = threading.Lock()
+
+
+def _fix_input_shape(model_path):
+    """
+    Pin the symbolic channel and sample dimensions of the model input to
+    INPUT_SHAPE so that onnxruntime can specialize kernels and plan memory once.
+    The batch dimension is left as is so spectra can be batched.
+
+    Parameters
+    ----------
+    model_path : str
+        Path to the ONNX model
+
+    Returns
+    -------
+    bytes or str
+        Serialized model with fixed dimensions, or the model path unchanged
+        if the onnx package is not installed
+    """
     try:
-        wavelengths = np.array(spectra['wavelengths'], dtype=np.float64)
-        fluxes = np.array(spectra['fluxes'], dtype=np.float64)
-    except Exception as e:
-        raise ValueError(f"Invalid input data in spectra: {e}")
+        import onnx
+        from onnx.tools.update_model_dims import update_inputs_outputs_dims
+    except ImportError:
+        return model_path
+
+    model = onnx.load(model_path)
+    initializers = {i.name for i in model.graph.initializer}
+    inputs = [i for i in model.graph.input if i.name not in initializers]
+
+    def dims(value_info):
+        return [d.dim_value or d.dim_param or -1 for d in value_info.type.tensor_type.shape.dim]
+
+    input_dims = {i.name: dims(i) for i in inputs}
+    input_dims[inputs[0].name] = dims(inputs[0])[:1] + list(INPUT_SHAPE[1:])
+    output_dims = {o.name: dims(o) for o in model.graph.output}
+
+    model = update_inputs_outputs_dims(model, input_dims, output_dims)
+    return model.SerializeToString()
+
+
+def _optimized_model_path(model_path):
+    # a saved graph is only valid for the onnxruntime version that optimized it
+    root, ext = os.path.splitext(model_path)
+    return f"{root}.ort{ort.__version__}.opt{ext}"
+
+
+def _save_optimized_model(model_path, optimized_path, providers):
+    """
+    Save the model optimized up to ORT_ENABLE_EXTENDED. The graph is written to a
+    temporary file and moved into place, so that another process never loads a partial file
+
+    Parameters
+    ----------
+    model_path : str
+        Path to the ONNX model
+    optimized_path : str
+        Path to save the optimized model to
+    providers : list
+        Execution providers of the session
+
+    Returns
+    -------
+    bool
+        True if the optimized model was saved, False if it could not be (e.g. read-only model directory)
+    """
+    root, ext = os.path.splitext(optimized_path)
+    tmp_path = f"{root}.{os.getpid()}.tmp{ext}"
+    save_options = ort.SessionOptions()
+    save_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    save_options.optimized_model_filepath = tmp_path
+    try:
+        ort.InferenceSession(_fix_input_shape(model_path), sess_options=save_options, providers=providers)
+        os.replace(tmp_path, optimized_path)
+        return True
+    except Exception:
+        logger.exception("Could not save the optimized model to %s, using %s", optimized_path, model_path)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+
+def _build_session(model_path):
+    """
+    Build an ONNX inference session for the given model (warming it up is left to warmup).
+    On CPU, the graph optimized up to ORT_ENABLE_EXTENDED is saved next to the
+    model on the first build and loaded on later starts, so only the
+    hardware-specific layout optimizations are applied again.
+
+    Parameters
+    ----------
+    model_path : str
+        Path to the ONNX model
+
+    Returns
+    -------
+    onnxruntime.InferenceSession
+        Inference session
+    str
+        Name of the model input
+    """
+    so = ort.SessionOptions()
+    # the model is small, a few threads are enough and leave cores to numpy/matplotlib
+    so.intra_op_num_threads = min(4, max(1, (os.cpu_count() or 2) // 2))
+    so.inter_op_num_threads = 1
+    so.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    available = ort.get_available_providers()
+    providers = [p for p in _PROVIDERS if (p if isinstance(p, str) else p[0]) in available]
+
+    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    # optimized graphs depend on the provider they were optimized for, so only persist them when running on CPU.
+    # ORT_ENABLE_ALL graphs also depend on the CPU and the session options, stop at ORT_ENABLE_EXTENDED
+    # so the saved graph can be shared between hosts
+    cpu_only = providers == ["CPUExecutionProvider"]
+    optimized_path = _optimized_model_path(model_path)
+    use_optimized = cpu_only
+    if cpu_only and (not os.path.exists(optimized_path)
+                     or os.path.getmtime(optimized_path) < os.path.getmtime(model_path)):
+        use_optimized = _save_optimized_model(model_path, optimized_path, providers)
+    model = optimized_path if use_optimized else _fix_input_shape(model_path)
+
+    session = ort.InferenceSession(model, sess_options=so, providers=providers)
+    return session, session.get_inputs()[0].name
+
+
+def _get_session():
+    """
+    Build the inference session for the selected model on first use and reuse it afterwards
+
+    Returns
+    -------
+    onnxruntime.InferenceSession
+        Cached inference session
+    str
+        Name of the model input
+    onnxruntime.IOBinding
+        Binding of the session to input_value, to be used under _BINDING_LOCK
+    onnxruntime.OrtValue
+        Input buffer for a single spectrum
+    """
+    global _SESSION, _INPUT_NAME, _IO_BINDING, _INPUT_VALUE
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            session, input_name = _build_session(_model_path)
+
+            # bind a reusable input buffer for single spectra, filled in place at each call
+            device = "cpu" if session.get_providers() == ["CPUExecutionProvider"] else "cuda"
+            input_value = ort.OrtValue.ortvalue_from_shape_and_type(list(INPUT_SHAPE), np.float32, device)
+            io_binding = session.io_binding()
+            io_binding.bind_ortvalue_input(input_name, input_value)
+            io_binding.bind_output(session.get_outputs()[0].name, "cpu")
+
+            _IO_BINDING, _INPUT_VALUE = io_binding, input_value
+            _SESSION, _INPUT_NAME = session, input_name
+        return _SESSION, _INPUT_NAME, _IO_BINDING, _INPUT_VALUE
+
+
+def warmup(n_runs=4):
+    """
+    Build the inference session and run it a few times on a dummy input of the
+    exact model shape, so that kernel selection, memory arenas and device
+    contexts are initialized before the first spectrum arrives
+
+    Parameters
+    ----------
+    n_runs : int, optional
+        Number of dummy inferences to run
+    """
+    session, input_name, _, _ = _get_session()
+    dummy = np.zeros(INPUT_SHAPE, dtype=np.float32)
+    for _ in range(n_runs):
+        session.run(None, {input_name: dummy})
+
+
+def set_model_path(model_path):
+    """
+    Select the ONNX model used by process_spectra (e.g. the quantized model)
+
+    Parameters
+    ----------
+    model_path : str
+        Path to the ONNX model
+    """
+    global _model_path, _SESSION, _INPUT_NAME, _IO_BINDING, _INPUT_VALUE
+    if not os.path.exists(model_path):
+        raise ValueError(f"Model file not found: {model_path}")
+    with _SESSION_LOCK:
+        _model_path = model_path
+        _SESSION, _INPUT_NAME = None, None
+        _IO_BINDING, _INPUT_VALUE = None, None
 
-    if len(wavelengths) != len(fluxes):
-        raise ValueError("Mismatched lengths between wavelengths and fluxes")
 
+def quantize_model(model_path=MODEL_PATH, quantized_path=QUANTIZED_MODEL_PATH):
+    """
+    Write an INT8 dynamically quantized copy of the model for CPU inference
+
+    Parameters
+    ----------
+    model_path : str
+        Path to the FP32 ONNX model
+    quantized_path : str
+        Path to write the quantized model to
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    # the CPU ConvInteger kernel only supports unsigned 8-bit weights
+    quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QUInt8)
+
+
+def model_drift(spectra_list, reference_path=MODEL_PATH, candidate_path=QUANTIZED_MODEL_PATH):
+    """
+    Compare the class probabilities of two models on the same spectra
+
+    Parameters
+    ----------
+    spectra_list : list[dict]
+        Spectra with 'wavelengths' and 'fluxes' keys
+    reference_path : str
+        Path to the reference ONNX model
+    candidate_path : str
+        Path to the ONNX model to validate
+
+    Returns
+    -------
+    float
+        Maximum absolute difference between class probabilities
+    float
+        Fraction of spectra where the best class differs
+    """
+    reference, reference_input = _build_session(reference_path)
+    candidate, candidate_input = _build_session(candidate_path)
+
+    max_diff, mismatches = 0.0, 0
+    for spectra in spectra_list:
+        input_data = preprocess_spectra(spectra)
+        logits_ref = reference.run(None, {reference_input: input_data})[0]
+        logits_cand = candidate.run(None, {candidate_input: input_data})[0]
+        p_ref, p_cand = softmax(logits_ref, axis=1), softmax(logits_cand, axis=1)
+        max_diff = max(max_diff, float(np.max(np.abs(p_ref - p_cand))))
+        mismatches += int(_logits_to_classes(logits_ref) != _logits_to_classes(logits_cand))
+    return max_diff, mismatches / max(len(spectra_list), 1)
+
+
+@njit(cache=True, nogil=True, fastmath=_FASTMATH)
+def _flux_zscore(wavelengths, fluxes, wl_lo, wl_hi, n):
     mask = np.isfinite(wavelengths) & np.isfinite(fluxes)
     if not np.any(mask):
         raise ValueError("No finite values in spectrum")
@@ -24,25 +302,138 @@ def flux_zscore(spectra, wavelength_range=(3850, 8500), interp_length=4650):
     if len(wavelengths_cleaned) < 2:
         raise ValueError("Too few data points after cleaning")
 
-    xs = np.linspace(wavelength_range[0], wavelength_range[1], interp_length)
-    ys = interp1d(wavelengths_cleaned, fluxes_cleaned, kind='linear', bounds_error=False,
-                  fill_value=(fluxes_cleaned[0], fluxes_cleaned[-1]))(xs)
+    # np.interp expects increasing wavelengths
+    if np.any(np.diff(wavelengths_cleaned) < 0):
+        order = np.argsort(wavelengths_cleaned, kind='mergesort')
+        wavelengths_cleaned = wavelengths_cleaned[order]
+        fluxes_cleaned = fluxes_cleaned[order]
+
+    xs = np.linspace(wl_lo, wl_hi, n)
+    # values outside the spectrum are clamped to the edge fluxes
+    ys = np.interp(xs, wavelengths_cleaned, fluxes_cleaned)
+
+    m, s = np.mean(ys), np.std(ys)
+    if s > 0:
+        return (ys - m) / s
+    return np.zeros(n, dtype=np.float64)
+
+
+def flux_zscore(spectra, wavelength_range=(3850, 8500), interp_length=4650):
+    try:
+        wavelengths = np.array(spectra['wavelengths'], dtype=np.float64)
+        fluxes = np.array(spectra['fluxes'], dtype=np.float64)
+    except Exception as e:
+        raise ValueError(f"Invalid input data in spectra: {e}")
+
+    if len(wavelengths) != len(fluxes):
+        raise ValueError("Mismatched lengths between wavelengths and fluxes")
+
+    return _flux_zscore(wavelengths, fluxes, float(wavelength_range[0]),
+                        float(wavelength_range[1]), int(interp_length))
+
+
+# compile the kernel at import so the first spectrum does not pay for it
+_flux_zscore(np.array([0.0, 1.0]), np.array([0.0, 1.0]), 0.0, 1.0, 2)
+
+def preprocess_spectra(spectra):
+    """
+    Normalize a spectrum into a model input
+
+    Parameters
+    ----------
+    spectra : dict
+        Spectrum with 'wavelengths' and 'fluxes' keys
+
+    Returns
+    -------
+    np.ndarray
+        float32 array of shape INPUT_SHAPE
+    """
+    return flux_zscore(spectra).reshape(INPUT_SHAPE).astype(np.float32)
+
+
+def _predict_logits(inputs):
+    """
+    Run the model on preprocessed spectra, in batches of at most MAX_BATCH_SIZE
+    or one at a time if the model was exported with a fixed batch size
+
+    Parameters
+    ----------
+    inputs : list[np.ndarray]
+        Model inputs returned by preprocess_spectra
+
+    Returns
+    -------
+    np.ndarray
+        Raw model outputs of shape (len(inputs), len(CLASSES))
+    """
+    ort_session, input_name, io_binding, input_value = _get_session()
+    batch_dim = ort_session.get_inputs()[0].shape[0]
+    batch_size = 1 if isinstance(batch_dim, int) else MAX_BATCH_SIZE
+
+    logits = []
+    for start in range(0, len(inputs), batch_size):
+        batch = inputs[start:start + batch_size]
+        if len(batch) == 1:
+            with _BINDING_LOCK:
+                input_value.update_inplace(batch[0])
+                ort_session.run_with_iobinding(io_binding)
+                logits.append(io_binding.copy_outputs_to_cpu()[0])
+        else:
+            logits.append(ort_session.run(None, {input_name: np.concatenate(batch, axis=0)})[0])
+    return np.concatenate(logits, axis=0)
+
+
+def _logits_to_probs(logits):
+    probs = softmax(logits, axis=1)
+    return [dict(zip(CLASSES, p)) for p in probs.tolist()]
+
+
+def _logits_to_classes(logits):
+    # softmax is monotonic, the best class is the argmax of the raw outputs
+    return [CLASSES[i] for i in np.argmax(logits, axis=1).tolist()]
+
+
+def process_spectra_batch(inputs):
+    """
+    Run the model once on several preprocessed spectra
+
+    Parameters
+    ----------
+    inputs : list[np.ndarray]
+        Model inputs returned by preprocess_spectra
+
+    Returns
+    -------
+    list[dict]
+        Class probabilities for each input, in the same order
+    """
+    return _logits_to_probs(_predict_logits(inputs))
 
-    m, s = np.nanmean(ys), np.nanstd(ys)
-    ys_norm = (ys - m) / s if s > 0 else np.zeros(interp_length, dtype=float)
-    return ys_norm
 
 def process_spectra(spectra):
-    input = flux_zscore(spectra)
-    input_data = np.array(input.reshape(1, 1, len(input)).astype(np.float32))
-
-    ort_session = ort.InferenceSession("SpectraCNN1D_4650.onnx")
-    ort_inputs = {ort_session.get_inputs()[0].name: input_data}
-    ort_outputs = ort_session.run(None, ort_inputs)
-    onnx_probs = ort_outputs[0]
-    onnx_probs_scipy = softmax(onnx_probs[0])
-    classes = ['AGN', 'Cataclysmic', 'II', 'IIP', 'IIb',
-               'IIn', 'Ia', 'Ib', 'Ic', 'Tidal Disruption Event']
-
-    output_dict = dict(zip(classes, onnx_probs_scipy.tolist()))
-    return output_dict
\ No newline at end of file
+    return process_spectra_batch([preprocess_spectra(spectra)])[0]
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Quantize the spectra classification model to INT8")
+    parser.add_argument("--model", type=str, default=MODEL_PATH,
+                        help="FP32 ONNX model (default: %(default)s)")
+    parser.add_argument("--output", type=str, default=QUANTIZED_MODEL_PATH,
+                        help="Quantized ONNX model (default: %(default)s)")
+    parser.add_argument("--validate", type=str,
+                        help="JSON file with a list of spectra ({'wavelengths': [...], 'fluxes': [...]}) "
+                             "used to measure the probability drift of the quantized model")
+    args = parser.parse_args()
+
+    quantize_model(args.model, args.output)
+    print(f"Quantized model written to {args.output}")
+
+    if args.validate:
+        with open(args.validate, "r") as f:
+            validation_spectra = json.load(f)
+        max_diff, mismatch_rate = model_drift(validation_spectra, args.model, args.output)
+        print(f"Max probability drift: {max_diff:.4f}, best class changed for {mismatch_rate:.2%} of spectra")
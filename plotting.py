@@ -0,0 +1,76 @@
+import io
+import os
+import threading
+from matplotlib.figure import Figure
+
+_FIG = None
+_AX = None
+# the figure is shared, results may be plotted from several threads
+_PLOT_LOCK = threading.Lock()
+
+
+def _get_axes():
+    """
+    Create the figure used for the probability plots on first use and reuse it afterwards
+
+    Returns
+    -------
+    matplotlib.figure.Figure
+        Cached figure
+    matplotlib.axes.Axes
+        Axes of the cached figure, cleared
+    """
+    global _FIG, _AX
+    if _FIG is None:
+        # not managed by pyplot, so it can be drawn outside of the main thread
+        _FIG = Figure(figsize=(10, 6))
+        _AX = _FIG.subplots()
+    _AX.clear()
+    return _FIG, _AX
+
+
+def _draw_probs(probs_dict):
+    classes = list(probs_dict.keys())
+    probs = list(probs_dict.values())
+
+    fig, ax = _get_axes()
+    bars = ax.bar(classes, probs, color='skyblue')
+    ax.set_ylabel("Probability")
+    ax.set_title("Classification probabilities")
+    ax.set_xticks(range(len(classes)))
+    ax.set_xticklabels(classes, rotation=45, ha='right')
+    ax.set_ylim(0, 1)
+
+    for bar, prob in zip(bars, probs):
+        yval = bar.get_height()
+        ax.text(bar.get_x() + bar.get_width() / 2, yval + 0.01, f"{prob:.2%}",
+                ha='center', va='bottom', fontsize=9)
+
+    fig.tight_layout()
+    return fig
+
+
+def plot_probs(probs_dict, save_path):
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    with _PLOT_LOCK:
+        _draw_probs(probs_dict).savefig(save_path)
+
+
+def plot_probs_png(probs_dict):
+    """
+    Render the probability plot in memory
+
+    Parameters
+    ----------
+    probs_dict : dict
+        Probability of each class
+
+    Returns
+    -------
+    bytes
+        PNG image of the plot
+    """
+    buf = io.BytesIO()
+    with _PLOT_LOCK:
+        _draw_probs(probs_dict).savefig(buf, format='png')
+    return buf.getvalue()
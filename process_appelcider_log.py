@@ -1,72 +1,81 @@
 import re
-from collections import defaultdict
 import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+ENTRY_SEPARATOR = '-' * 40
+
+_OBJ = re.compile(r'Object ID:\s+(\S+)')
+_SPEC = re.compile(r'Spectra ID:\s+(\d+)')
+_SKY = re.compile(r'SkyPortal classifications:\s+(.+?)Apple-cider classification:', re.DOTALL)
+_APPLE = re.compile(r'Apple-cider classification:\s+(\w+)')
+_DUPLICATE = re.compile('duplicate', re.IGNORECASE)
+_CLS = re.compile(r'-?([A-Za-z0-9]+)[^ ]*\s+\(prob=(\d+\.\d+)%\)')
 
 def extract_best_skyportal_class(text):
-    if "duplicate" in text.lower():
+    if _DUPLICATE.search(text):
         return None, []
 
-    matches = re.findall(r'-?([A-Za-z0-9]+)[^ ]*\s+\(prob=(\d+\.\d+)%\)', text)
+    matches = _CLS.findall(text)
     if not matches:
         return None, []
-    matches = [("Tidal Disruption Event" if "Event" in cls else cls, float(prob)) for cls, prob in matches]
-    best_class = max(matches, key=lambda x: x[1])
-    return best_class[0], matches
+    probs = np.fromiter((float(prob) for _, prob in matches), dtype=np.float64, count=len(matches))
+    matches = [("Tidal Disruption Event" if "Event" in cls else cls, prob)
+               for (cls, _), prob in zip(matches, probs.tolist())]
+    return matches[int(probs.argmax())][0], matches
+
+def _iter_entries(f):
+    """Yield the log entries one at a time, without loading the whole file"""
+    lines = []
+    for line in f:
+        if line.strip() == ENTRY_SEPARATOR:
+            yield ''.join(lines)
+            lines = []
+        else:
+            lines.append(line)
+    if lines:
+        yield ''.join(lines)
 
 def parse_log_file(filepath):
-    with open(filepath, "r") as f:
-        content = f.read()
-
-    entries = content.strip().split('----------------------------------------')
     data = []
-
-    for entry in entries:
-        if not entry.strip():
-            continue
-
-        object_id = re.search(r'Object ID:\s+(\S+)', entry)
-        spectra_id = re.search(r'Spectra ID:\s+(\d+)', entry)
-        skyportal_block = re.search(r'SkyPortal classifications:\s+(.+?)Apple-cider classification:', entry, re.DOTALL)
-        apple_class = re.search(r'Apple-cider classification:\s+(\w+)', entry)
-
-        if object_id and spectra_id and skyportal_block and apple_class:
-            best_sky_class, _ = extract_best_skyportal_class(skyportal_block.group(1))
-            if best_sky_class is None:
+    with open(filepath, "r") as f:
+        for entry in _iter_entries(f):
+            if not entry.strip():
                 continue
 
-            data.append({
-                "object_id": object_id.group(1),
-                "spectra_id": int(spectra_id.group(1)),
-                "skyportal_class": best_sky_class,
-                "apple_class": apple_class.group(1)
-            })
-    return data
-
-def compute_class_accuracy(data):
-    class_stats = defaultdict(lambda: {"match": 0, "total": 0, "apple_classes": set()})
-    for entry in data:
-        sky = entry["skyportal_class"]
-        apple = entry["apple_class"]
-
-        class_stats[sky]["total"] += 1
-        if sky == apple:
-            class_stats[sky]["match"] += 1
-        class_stats[sky]["apple_classes"].add(apple)
-    return class_stats
+            object_id = _OBJ.search(entry)
+            spectra_id = _SPEC.search(entry)
+            skyportal_block = _SKY.search(entry)
+            apple_class = _APPLE.search(entry)
+
+            if object_id and spectra_id and skyportal_block and apple_class:
+                best_sky_class, _ = extract_best_skyportal_class(skyportal_block.group(1))
+                if best_sky_class is None:
+                    continue
+
+                data.append({
+                    "object_id": object_id.group(1),
+                    "spectra_id": int(spectra_id.group(1)),
+                    "skyportal_class": best_sky_class,
+                    "apple_class": apple_class.group(1)
+                })
+    return pd.DataFrame(data, columns=["object_id", "spectra_id", "skyportal_class", "apple_class"])
+
+def compute_class_accuracy(df):
+    df = df.assign(match=df["skyportal_class"] == df["apple_class"])
+    return df.groupby("skyportal_class").agg(
+        match=("match", "sum"),
+        total=("match", "size"),
+        apple_classes=("apple_class", lambda s: ", ".join(sorted(set(s)))),
+    )
 
 def plot_class_comparison(class_stats):
-    sky_classes = sorted(class_stats.keys())
-    match_rates = [
-        100 * class_stats[c]["match"] / class_stats[c]["total"]
-        for c in sky_classes
-    ]
-
-    apple_labels = [
-        ", ".join(sorted(class_stats[c]["apple_classes"]))
-        for c in sky_classes
-    ]
-
-    sample_counts = [class_stats[c]["total"] for c in sky_classes]
+    sky_classes = class_stats.index.tolist()
+    match_rates = (100 * class_stats["match"] / class_stats["total"]).tolist()
+
+    apple_labels = class_stats["apple_classes"].tolist()
+
+    sample_counts = class_stats["total"].tolist()
 
     # Format top-axis labels like: "Ia (45)"
     skyportal_labels = [f"{cls} ({count})" for cls, count in zip(sky_classes, sample_counts)]
@@ -1,29 +1,10 @@
 import base64
-import os
-import matplotlib.pyplot as plt
+import threading
 
-def plot_probs(probs_dict, save_path):
-    os.makedirs(os.path.dirname(save_path), exist_ok=True)
-
-    classes = list(probs_dict.keys())
-    probs = list(probs_dict.values())
-
-    plt.figure(figsize=(10, 6))
-    bars = plt.bar(classes, probs, color='skyblue')
-    plt.ylabel("Probability")
-    plt.title("Classification probabilities")
-    plt.xticks(rotation=45, ha='right')
-    plt.ylim(0, 1)
-
-    for bar, prob in zip(bars, probs):
-        yval = bar.get_height()
-        plt.text(bar.get_x() + bar.get_width() / 2, yval + 0.01, f"{prob:.2%}",
-                 ha='center', va='bottom', fontsize=9)
-
-    plt.tight_layout()
-    plt.savefig(save_path)
-    plt.close()
+from plotting import plot_probs, plot_probs_png
 
+# keep the lines of concurrent log entries together
+_LOG_LOCK = threading.Lock()
 
 def store_result(client, obj_id, spectra_id, ml_result, log_path):
     plot_probs(ml_result, save_path=f"ml_results/{obj_id}_{spectra_id}_ML_probs.png")
@@ -42,7 +23,7 @@ def store_result(client, obj_id, spectra_id, ml_result, log_path):
 
     best_result = max(ml_result, key=ml_result.get)
     best_score = ml_result[best_result]
-    with open(log_path, "a") as log_file:
+    with _LOG_LOCK, open(log_path, "a") as log_file:
         log_file.write(f"Object ID: {obj_id}\n")
         if spectra_id:
             log_file.write(f"Spectra ID: {spectra_id}\n")
@@ -52,19 +33,16 @@ def store_result(client, obj_id, spectra_id, ml_result, log_path):
         log_file.write("-" * 40 + "\n")
 
 
-def post_result(client, obj_id, ml_result, attach_path=None):
+def post_result(client, obj_id, ml_result, attach_name=None):
     best_result = max(ml_result, key=ml_result.get)
     data = {
         "text": "Machine Learning Classification using spectra:\n\n"
                 f"Best result: '{best_result}' with probability {ml_result[best_result]:.2%}\n\n"
     }
 
-    if attach_path:
-        plot_probs(ml_result, attach_path)
-        with open(attach_path, "rb") as img_file:
-            at_str = base64.b64encode(img_file.read()).decode('utf-8')
-
-        data['attachment'] = {'body': at_str, 'name': os.path.basename(attach_path)}
+    if attach_name:
+        at_str = base64.b64encode(plot_probs_png(ml_result)).decode('ascii')
+        data['attachment'] = {'body': at_str, 'name': attach_name}
 
     status, data = client.api('POST', f"/api/sources/{obj_id}/comments", data=data)
 
@@ -74,6 +52,6 @@ def post_result(client, obj_id, ml_result, attach_path=None):
 
 def process_result(client, obj_id, spectra_id, ml_result, publish_to_skyportal):
     if ml_result and publish_to_skyportal:
-        post_result(client, obj_id, ml_result, attach_path=f"ml_results/{obj_id}_{spectra_id}_ML_probs.png")
+        post_result(client, obj_id, ml_result, attach_name=f"{obj_id}_{spectra_id}_ML_probs.png")
     else:
         store_result(client, obj_id, spectra_id, ml_result, log_path='ml_results.log')
\ No newline at end of file
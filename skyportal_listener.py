@@ -1,6 +1,15 @@
 import argparse
+import logging
+import os
+import threading
+
+# keep BLAS/OpenMP single threaded so they do not compete with onnxruntime,
+# this must be set before numpy is imported
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
 
 from api import SkyPortal
+from execute_model import MODEL_PATH, set_model_path, warmup
 from spectra_listener import monitor_spectra
 
 INSTANCE_URL = "https://fritz.science"
@@ -8,9 +17,6 @@ API_TOKEN = ""  # Replace with your actual API token
 POLL_INTERVAL = 120  # Polling interval in seconds
 LOOKBACK_DAYS = 1
 
-seen_sources = set() # Track seen source ids to avoid duplication
-header = {}
-
 def parse_args():
     parser = argparse.ArgumentParser(
         description=(
@@ -26,10 +32,14 @@ def parse_args():
     parser.add_argument("--token", type=str, help="API token")
     parser.add_argument("--interval", type=int, default=POLL_INTERVAL,
                         help="Polling interval in seconds (default: %(default)s)")
+    parser.add_argument("--max-interval", type=int, default=None,
+                        help="Maximum polling interval in seconds when no new spectra are found (default: 32 x interval)")
     parser.add_argument("--lookback", type=int, default=LOOKBACK_DAYS,
                         help="Number of days to look back for new spectra (default: %(default)s)")
     parser.add_argument("--output", type=str, default="store", choices=["publish", "store"],
                         help="Output mode: 'publish' to SkyPortal, 'store' to log to a file (default: %(default)s)")
+    parser.add_argument("--model", type=str, default=MODEL_PATH,
+                        help="ONNX model to use, e.g. the INT8 model written by execute_model.py (default: %(default)s)")
     return parser.parse_args()
 
 
@@ -41,14 +51,14 @@ if __name__ == "__main__":
     POLL_INTERVAL = args.interval
     LOOPBACK_DAYS = args.lookback
     output = args.output
-
+    set_model_path(args.model)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 
     if not API_TOKEN:
         print("API token is required. Please provide it using --token.")
         exit(1)
     else:
         print(f"Starting SkyPortal listener...")
-    header = {"Authorization": f"token {API_TOKEN}"}
 
     client = SkyPortal(
         instance=INSTANCE_URL,
@@ -56,6 +66,9 @@ if __name__ == "__main__":
         token=API_TOKEN,
     )
 
+    # load and warm up the model in the background while the listener starts polling
+    threading.Thread(target=warmup, daemon=True).start()
+
     # start monitoring the spectra
     monitor_spectra(
         client,
@@ -63,6 +76,7 @@ if __name__ == "__main__":
         # Ids correspond to: LRIS, KAST, SPRAT, SEDM, ALFOSC, DBSP, NGPS, GHTS TODO- add KCWI (1102) and Binospec (1076)
         lookback=LOOPBACK_DAYS,
         interval=POLL_INTERVAL,
+        max_interval=args.max_interval,
         publish_to_skyportal=output == "publish",
         verbose=True,
         use_cache=True,
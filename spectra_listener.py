@@ -1,13 +1,34 @@
+import logging
+import mmap
 import os
+import threading
 import time
-import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
 
+import numpy as np
+
 from api import SkyPortal
-from execute_model import process_spectra
+from execute_model import preprocess_spectra, process_spectra_batch
 from process_result import process_result
 
-default_cache_name = 'spectra_listener_cache.txt'
+logger = logging.getLogger(__name__)
+
+default_cache_name = 'spectra_listener_cache.bin'
+sorted_cache_name = 'spectra_listener_cache.sorted.bin'
+legacy_cache_name = 'spectra_listener_cache.txt'
+# number of appended IDs above which they are merged into the sorted cache
+cache_compaction_threshold = 10000
+# the cache stores the IDs as packed little-endian uint64
+_CACHE_DTYPE = np.dtype('<u8')
+_TRUTHY = frozenset({'True', 'true', 'T', 't', 'Yes', 'yes', 'Y', 'y', '1', 1, True})
+max_workers = 8
+# limit the number of simultaneous requests to avoid hitting the API too fast
+api_semaphore = threading.Semaphore(4)
+# margin kept before the end of the last poll, for spectra committed with a slightly older modified date
+cursor_overlap = timedelta(minutes=5)
+# number of polls at which a failing spectrum is tried before giving up on it
+max_retries = 5
 
 def validate_monitor_spectra_args(
         client: SkyPortal,
@@ -16,6 +37,7 @@ def validate_monitor_spectra_args(
         interval: int,
         use_cache: bool,
         cache_dir: str,
+        max_interval: int = None,
 ):
     """
     Validate the arguments for the monitor_spectra function
@@ -34,6 +56,8 @@ def validate_monitor_spectra_args(
         If True, cache processed spectra
     cache_dir : str
         Path to the cache directory
+    max_interval : int, optional
+        Maximum number of seconds to wait between queries when no new spectra are found
     function : callable
         Function to call on each new spectrum
     """
@@ -49,6 +73,9 @@ def validate_monitor_spectra_args(
     if not isinstance(interval, int) or interval < 0:
         raise ValueError('interval must be a non-negative integer')
 
+    if max_interval is not None and (not isinstance(max_interval, int) or max_interval < interval):
+        raise ValueError('max_interval must be an integer greater than or equal to interval')
+
     if use_cache:
         if not isinstance(cache_dir, str):
             raise ValueError('cache_dir must be a string if use_cache is True')
@@ -76,55 +103,255 @@ def str_to_bool(value: bool):
     bool
         Value argument as a boolean
     """
-    if value in ['True', 'true', 'T', 't', 'Yes', 'yes', 'Y', 'y', '1', 1, True]:
-        return True
-    else:
+    try:
+        return value in _TRUTHY
+    except TypeError:  # unhashable value
         return False
 
 
-def _load_existing_cache(cache_dir: str, function_name: str):
+def _cache_path(cache_dir: str, function_name: str, cache_name: str):
+    return os.path.join(cache_dir, f'{function_name}_{cache_name}')
+
+
+def _ids_to_bytes(ids):
+    return np.asarray(ids, dtype=_CACHE_DTYPE).tobytes()
+
+
+def _read_ids(path: str):
     """
-    Load the existing cache from disk
+    Read the IDs of an append-only cache file
 
     Parameters
     ----------
-    cache_dir : str
-        Path to the cache directory
-    function_name : str
-        Name of the function called on the spectra
+    path : str
+        Path to the cache file
 
     Returns
     -------
-    Set[int]
-        Spectrum IDs that have already been processed by the function
+    np.ndarray
+        IDs in the file, empty if it does not exist
     """
-    cache_name = f'{function_name}_{default_cache_name}'
     try:
-        with open(f'{cache_dir}/{cache_name}', 'r') as f:
-            return set([int(line) for line in f.read().splitlines()])
+        with open(path, 'rb') as f:
+            data = f.read()
     except FileNotFoundError:
-        return set()
+        return np.empty(0, dtype=_CACHE_DTYPE)
+
+    # drop a partially written last ID so that the next appends stay aligned
+    size = len(data) - len(data) % _CACHE_DTYPE.itemsize
+    if size != len(data):
+        os.truncate(path, size)
+    return np.frombuffer(data, dtype=_CACHE_DTYPE, count=size // _CACHE_DTYPE.itemsize)
 
 
-def _cache_spectra(id: int, cache_dir: str, function_name: str):
+def _map_ids(path: str):
     """
-    Add a spectrum ID to the cache on disk to avoid duplicates in the future
+    Memory-map a sorted cache file, so that it is paged in on access instead of read at startup
+
+    Parameters
+    ----------
+    path : str
+        Path to the sorted cache file
+
+    Returns
+    -------
+    np.ndarray
+        Read-only view of the sorted IDs, empty if the file does not exist
+    """
+    try:
+        size = os.path.getsize(path)
+    except FileNotFoundError:
+        size = 0
+    if size < _CACHE_DTYPE.itemsize:
+        return np.empty(0, dtype=_CACHE_DTYPE)
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return np.frombuffer(mm, dtype=_CACHE_DTYPE, count=size // _CACHE_DTYPE.itemsize)
+
+
+class ProcessedSpectra:
+    """
+    Set-like collection of the spectrum IDs processed by a function, backed by the cache on disk.
+    Most IDs live in a sorted file that is memory-mapped and searched with a binary search,
+    the ones appended since the last compaction are kept in a small in-memory set.
+    Without a cache directory, the IDs are kept in the same layout, in memory only.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        Path to the cache directory, None to keep the IDs in memory only
+    function_name : str, optional
+        Name of the function called on the spectra
+    """
+
+    def __init__(self, cache_dir: str = None, function_name: str = None):
+        if cache_dir is None:
+            self.sorted_path = self.tail_path = None
+            self._sorted = np.empty(0, dtype=_CACHE_DTYPE)
+            self._tail = set()
+            self._tail_file = None
+            return
+        self.sorted_path = _cache_path(cache_dir, function_name, sorted_cache_name)
+        self.tail_path = _cache_path(cache_dir, function_name, default_cache_name)
+        self._sorted = _map_ids(self.sorted_path)
+        tail = _read_ids(self.tail_path)
+        self._tail = set(tail[~self._in_sorted(tail)].tolist())
+        # kept open for the lifetime of the cache, appends always go to the end of the file
+        self._tail_file = open(self.tail_path, 'ab')
+        # a cache written before the sorted file existed (or migrated from the text cache)
+        # is sorted once right away, whatever its size
+        self.maybe_compact(force=len(self._tail) > 0 and not os.path.exists(self.sorted_path))
+
+    def _in_sorted(self, ids):
+        idx = np.searchsorted(self._sorted, ids)
+        found = idx < len(self._sorted)
+        found[found] = self._sorted[idx[found]] == ids[found]
+        return found
+
+    def __contains__(self, id):
+        if id in self._tail:
+            return True
+        i = np.searchsorted(self._sorted, id)
+        return bool(i < len(self._sorted) and self._sorted[i] == id)
+
+    def __len__(self):
+        return len(self._sorted) + len(self._tail)
+
+    def add(self, id: int):
+        """Add an ID in memory, writing it to disk is left to write"""
+        self._tail.add(id)
+
+    def write(self, ids: list[int]):
+        """
+        Append spectrum IDs to the cache on disk with a single write and fsync,
+        then compact the cache if needed. If the append fails, the error is raised
+        and the IDs must be written again
+
+        Parameters
+        ----------
+        ids : list[int]
+            Spectrum IDs that are not on disk yet
+        """
+        self._tail.update(ids)
+        if self._tail_file is None:
+            self.maybe_compact()
+            return
+        if self._tail_file.closed:
+            # reopening failed after a previous error
+            self._reopen_tail()
+        try:
+            self._tail_file.write(_ids_to_bytes(ids))
+            self._tail_file.flush()
+            os.fsync(self._tail_file.fileno())
+        except OSError:
+            self._reopen_tail()
+            raise
+
+        # the appended IDs are safe on disk, a failed compaction leaves the files
+        # as they were and is tried again at the next write
+        try:
+            self.maybe_compact()
+        except OSError:
+            logger.exception('Error compacting the cache %s', self.sorted_path)
+
+    def _reopen_tail(self):
+        """
+        Close the append handle after a failed write, and drop the partial ID
+        it may have left at the end of the file so that the next appends stay aligned
+        """
+        try:
+            self._tail_file.close()
+        except OSError:
+            pass
+        size = os.path.getsize(self.tail_path)
+        os.truncate(self.tail_path, size - size % _CACHE_DTYPE.itemsize)
+        self._tail_file = open(self.tail_path, 'ab')
+
+    def maybe_compact(self, force: bool = False):
+        """
+        Merge the appended IDs into the sorted cache file once there are more than
+        cache_compaction_threshold of them, and empty the append-only file
+        (in memory only, merge them into the sorted array)
+
+        Parameters
+        ----------
+        force : bool, optional
+            If True, merge the appended IDs whatever their number
+        """
+        if not force and len(self._tail) <= cache_compaction_threshold:
+            return
+        tail = np.fromiter(self._tail, dtype=_CACHE_DTYPE, count=len(self._tail))
+        merged = np.union1d(self._sorted, tail)
+        if self.sorted_path is None:
+            self._sorted = merged
+            self._tail = set()
+            return
+
+        # release the mapping of the old file before replacing it
+        self._sorted = merged
+        tmp_path = f'{self.sorted_path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(merged.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.sorted_path)
+        # make the rename durable before emptying the tail, a crash before
+        # the truncation only leaves IDs in both files
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.sorted_path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        open(self.tail_path, 'wb').close()
+
+        self._sorted = _map_ids(self.sorted_path)
+        self._tail = set()
+
+
+def _migrate_legacy_cache(cache_dir: str, function_name: str):
+    """
+    Convert the text cache (one ID per line) written by previous versions
+    to the binary format, if there is one and no binary cache yet
 
     Parameters
     ----------
-    id : int
-        Spectrum ID
     cache_dir : str
         Path to the cache directory
     function_name : str
         Name of the function called on the spectra
     """
-    cache_name = f'{function_name}_{default_cache_name}'
-    # if the id is not in the cache yet, add it
-    already_processed = _load_existing_cache(cache_dir, function_name)
-    if id not in already_processed:
-        with open(f'{cache_dir}/{cache_name}', 'a') as f:
-            f.write(f'{id}\n')
+    cache_path = _cache_path(cache_dir, function_name, default_cache_name)
+    sorted_path = _cache_path(cache_dir, function_name, sorted_cache_name)
+    legacy_path = _cache_path(cache_dir, function_name, legacy_cache_name)
+    if os.path.exists(cache_path) or os.path.exists(sorted_path) or not os.path.exists(legacy_path):
+        return
+    if os.path.getsize(legacy_path) == 0:
+        ids = []
+    else:
+        # parse in C rather than calling int() on each line
+        ids = np.loadtxt(legacy_path, dtype=np.int64, ndmin=1)
+    with open(cache_path, 'wb') as f:
+        f.write(_ids_to_bytes(ids))
+
+
+def _load_existing_cache(cache_dir: str, function_name: str):
+    """
+    Load the existing cache from disk
+
+    Parameters
+    ----------
+    cache_dir : str
+        Path to the cache directory
+    function_name : str
+        Name of the function called on the spectra
+
+    Returns
+    -------
+    ProcessedSpectra
+        Spectrum IDs that have already been processed by the function
+    """
+    _migrate_legacy_cache(cache_dir, function_name)
+    return ProcessedSpectra(cache_dir, function_name)
 
 
 def _clear_cache(cache_dir: str, function_name: str):
@@ -138,9 +365,86 @@ def _clear_cache(cache_dir: str, function_name: str):
     function_name : str
         Name of the function called on the spectra
     """
-    cache_name = f'{function_name}_{default_cache_name}'
-    with open(f'{cache_dir}/{cache_name}', 'w') as f:
-        f.write('')
+    for cache_name in (default_cache_name, sorted_cache_name):
+        with open(_cache_path(cache_dir, function_name, cache_name), 'wb') as f:
+            f.write(b'')
+
+
+def _fetch_and_preprocess(client: SkyPortal, s: dict):
+    """
+    Fetch the full payload of a spectrum listed with a minimal payload,
+    and normalize it into a model input
+
+    Parameters
+    ----------
+    client : SkyPortal
+        SkyPortal API client
+    s : dict
+        Spectrum metadata from the listing
+
+    Returns
+    -------
+    np.ndarray
+        Model input for the spectrum
+    """
+    with api_semaphore:
+        status, data = client.get_spectra(id=s['id'])
+    if status != 200:
+        raise ValueError(f'Error fetching spectra {s["id"]}: {data}')
+    return preprocess_spectra(data['data'])
+
+
+def _classify(fetched: list[dict], inputs: list):
+    """
+    Run the model on the new spectra in one batch. If the batch fails, retry the
+    spectra one by one so that a single bad input does not block the others
+
+    Parameters
+    ----------
+    fetched : list[dict]
+        Spectra to classify
+    inputs : list[np.ndarray]
+        Their preprocessed model inputs, in the same order
+
+    Returns
+    -------
+    list[tuple[dict, dict]]
+        Spectrum and class probabilities of each spectrum classified successfully
+    """
+    try:
+        return list(zip(fetched, process_spectra_batch(inputs)))
+    except Exception:
+        if len(inputs) == 1:
+            logger.exception('Error running the model on spectra %s', fetched[0]['id'])
+            return []
+        logger.exception('Error running the model on %d spectra, retrying them one by one', len(inputs))
+
+    classified = []
+    for s, input_data in zip(fetched, inputs):
+        try:
+            classified.append((s, process_spectra_batch([input_data])[0]))
+        except Exception:
+            logger.exception('Error running the model on spectra %s', s['id'])
+    return classified
+
+
+def _publish_result(client: SkyPortal, s: dict, ml_result: dict, publish_to_skyportal: bool):
+    """
+    Store or publish the result of a spectrum, rate-limited by api_semaphore
+
+    Parameters
+    ----------
+    client : SkyPortal
+        SkyPortal API client
+    s : dict
+        Spectrum the result was computed on
+    ml_result : dict
+        Class probabilities returned by the model
+    publish_to_skyportal : bool
+        If True, publish the result to SkyPortal as a comment
+    """
+    with api_semaphore:
+        process_result(client, s['obj_id'], s['id'], ml_result, publish_to_skyportal)
 
 
 def monitor_spectra(
@@ -153,12 +457,15 @@ def monitor_spectra(
         use_cache: bool,
         cache_dir: str,
         clear_cache: bool,
+        max_interval: int = None,
         *args, **kwargs
 ):
     """
     Monitor SkyPortal for new spectra taken with the specified instruments
     and call the specified function on each new spectrum.
     Keep track of already processed spectra to avoid duplicates.
+    The first query covers the lookback window, later ones only the spectra
+    modified since the last query in which every spectrum was processed.
 
     Parameters
     ----------
@@ -180,6 +487,9 @@ def monitor_spectra(
         Path to the cache directory
     clear_cache : bool
         If True, clear the cache before starting
+    max_interval : int, optional
+        Maximum number of seconds to wait between queries. The wait doubles after
+        each query without new spectra, up to this value (default: interval * 32)
     args : list
         Positional arguments to pass to the function
     kwargs : dict
@@ -188,59 +498,147 @@ def monitor_spectra(
     verbose = str_to_bool(verbose)
     use_cache = str_to_bool(use_cache)
     clear_cache = str_to_bool(clear_cache)
-    validate_monitor_spectra_args(client, instrument_ids, lookback, interval, use_cache, cache_dir)
+    validate_monitor_spectra_args(client, instrument_ids, lookback, interval, use_cache, cache_dir, max_interval)
+    if max_interval is None:
+        max_interval = interval * 32
+    current_interval = interval
+    # end of the last polled window
+    last_polled = None
+    # spectra that failed, fetched again by ID at the next polls: ID -> (spectrum, number of failed attempts)
+    retries = {}
+    # processed spectra whose cache write failed
+    unsaved = []
+    # polls are scheduled on a monotonic clock, so their period does not drift with the processing time
+    next_wake = time.monotonic()
 
     if use_cache:
         if clear_cache:
             _clear_cache(cache_dir, "process_spectra")
         already_processed = _load_existing_cache(cache_dir, "process_spectra")
     else:
-        already_processed = set()
-
-    while True:
-        modified_before = datetime.now(timezone.utc)
-        modified_after = modified_before - timedelta(days=lookback)
-        status, data = client.get_spectra(
-            instrument_ids=instrument_ids,
-            modified_after=modified_after.isoformat().split('+')[0],
-            modified_before=modified_before.isoformat().split('+')[0],
-            minimal=True
-        )
-        if status != 200:
-            print(f'Error fetching spectra: {data}')
-            time.sleep(10)
-            continue
-
-        all_spectra = [s for s in data['data'] if s['id'] not in already_processed]
-        if verbose and len(all_spectra) > 0:
-            print(f'Found {len(all_spectra)} new spectra at {modified_before}')
-
-        start = time.time()
-        for s in all_spectra:
-            try:
+        # same compact layout as the cache, without the files
+        already_processed = ProcessedSpectra()
+
+    # the worker threads are kept for the whole lifetime of the listener
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            # naive UTC datetimes, formatted without offset for the API
+            modified_before = datetime.now(timezone.utc).replace(tzinfo=None)
+            modified_after = modified_before - timedelta(days=lookback)
+            if last_polled is not None:
+                # only ask for what changed since the last poll
+                modified_after = max(modified_after, last_polled - cursor_overlap)
+            # the first window is the whole lookback, mostly already processed spectra: list their
+            # IDs only and fetch the new ones. Later windows start at the cursor, which moves at every
+            # poll, and are short, and with an empty cache every spectrum is new, so both are listed
+            # with their full payload directly
+            minimal = last_polled is None and len(already_processed) > 0
+            status, data = client.get_spectra(
+                instrument_ids=instrument_ids,
+                modified_after=modified_after.isoformat(),
+                modified_before=modified_before.isoformat(),
+                minimal=minimal,
+                # every spectrum of the previous listing was processed or is retried by ID
+                conditional=last_polled is not None
+            )
+            if status != 200:
+                logger.error('Error fetching spectra: %s', data)
+                time.sleep(10)
+                next_wake = time.monotonic()
+                continue
+
+            all_spectra = [
+                s for s in data['data'] if s['id'] not in already_processed and s['id'] not in retries
+            ]
+            if verbose and len(all_spectra) > 0:
+                logger.info('Found %d new spectra at %s', len(all_spectra), modified_before)
+            # spectra that failed at a previous poll are fetched again by ID, even out of the window
+            retried = [s for s, attempts in retries.values() if attempts < max_retries]
+
+            start = time.time()
+            fetched, inputs = [], []
+            # fetch (if needed) and preprocess the new spectra concurrently
+            futures = {}
+            for s in all_spectra:
                 if verbose:
-                    print(f'New spectra: {s["id"]}')
-                status, data = client.get_spectra(id=s['id'])
-                if status != 200:
-                    raise ValueError(f'Error fetching spectra {s["id"]}: {data}')
-                ml_result = process_spectra(data['data'])
-                process_result(client, s['obj_id'], s['id'], ml_result, publish_to_skyportal)
-
-                if use_cache:
-                    _cache_spectra(s['id'], cache_dir, "process_spectra")
-                already_processed.add(s['id'])
-
-                time.sleep(0.5)  # avoid hitting the API too fast
-            except Exception as e:
-                traceback.print_exc()
-                print(f'Error processing spectra {s["id"]}: {e}')
-
-        if verbose:
-            if len(all_spectra) > 0:
-                print(
-                    f'Processed {len(already_processed)} spectra in {time.time() - start:.2f} seconds (sleeping for {interval} seconds)')
-            else:
-                print(
-                    f'No new spectra found between {modified_after} and {modified_before} (sleeping for {interval} seconds)')
-
-        time.sleep(interval)
\ No newline at end of file
+                    logger.info('New spectra: %s', s['id'])
+                if minimal:
+                    futures[executor.submit(_fetch_and_preprocess, client, s)] = s
+                else:
+                    futures[executor.submit(preprocess_spectra, s)] = s
+            for s in retried:
+                futures[executor.submit(_fetch_and_preprocess, client, s)] = s
+
+            for future in as_completed(futures):
+                s = futures[future]
+                try:
+                    inputs.append(future.result())
+                    fetched.append(s)
+                except Exception:
+                    logger.exception('Error processing spectra %s', s['id'])
+
+            # run the model on all the new spectra at once, batched by process_spectra_batch
+            classified = _classify(fetched, inputs) if inputs else []
+
+            # store or publish the results concurrently, the processed set and the cache
+            # are only updated from this thread
+            futures = {
+                executor.submit(_publish_result, client, s, ml_result, publish_to_skyportal): s
+                for s, ml_result in classified
+            }
+            pending_cache = []
+            for future in as_completed(futures):
+                s = futures[future]
+                try:
+                    future.result()
+
+                    if s['id'] not in already_processed:
+                        pending_cache.append(s['id'])
+                    already_processed.add(s['id'])
+                except Exception:
+                    logger.exception('Error processing spectra %s', s['id'])
+
+            # write the newly processed spectra to the cache once per cycle (only compacts them in memory without a cache).
+            # A failed write must not stop the listener, its IDs are written again with the next ones
+            unsaved += pending_cache
+            if unsaved:
+                try:
+                    already_processed.write(unsaved)
+                    unsaved = []
+                except Exception:
+                    logger.exception('Error writing %d spectra to the cache', len(unsaved))
+
+            # keep the spectra that failed for the next polls, up to max_retries attempts. Given up
+            # spectra stay in retries so they are not picked up again from the cursor overlap
+            for s in all_spectra + retried:
+                if s['id'] in already_processed:
+                    retries.pop(s['id'], None)
+                    continue
+                attempts = retries[s['id']][1] + 1 if s['id'] in retries else 1
+                retries[s['id']] = ({'id': s['id'], 'obj_id': s['obj_id']}, attempts)
+                if attempts == max_retries:
+                    logger.warning('Giving up on spectra %s after %d failed attempts', s['id'], attempts)
+
+            # the failed spectra are retried by ID, so the window always moves forward
+            last_polled = modified_before
+
+            # back off while nothing new comes in, poll at the normal rate again as soon as something does
+            current_interval = interval if all_spectra else min(current_interval * 2, max_interval)
+            next_wake += current_interval
+            now = time.monotonic()
+            if next_wake < now:
+                # the processing took longer than the interval, skip the missed polls
+                next_wake = now
+            sleep_time = next_wake - now
+
+            if verbose:
+                if len(all_spectra) > 0 or len(retried) > 0:
+                    logger.info(
+                        'Processed %d spectra in %.2f seconds (sleeping for %.0f seconds)',
+                        len(already_processed), time.time() - start, sleep_time)
+                else:
+                    logger.info(
+                        'No new spectra found between %s and %s (sleeping for %.0f seconds)',
+                        modified_after, modified_before, sleep_time)
+
+            time.sleep(sleep_time)
\ No newline at end of file